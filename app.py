@@ -1,10 +1,12 @@
 import streamlit as st
-import google.generativeai as genai
-import pandas as pd
-import json
+import orjson
 import time
 import io
 import re
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+# Heavy deps (google.generativeai, pandas, PIL, xlsxwriter) are imported inside the code
+# that uses them, so the first (cold) run renders the UI sooner. Later reruns just hit sys.modules.
 
 # --- 1. BANETTI BRANDING & CONFIG ---
 st.set_page_config(
@@ -56,156 +58,222 @@ Unified extraction for **Sticky Notes**, **Dot-Voting Matrices**, and **Hybrid L
 
 # --- 2. HELPER FUNCTIONS ---
 
+# Bump whenever FINAL_PROMPT or FINAL_SCHEMA changes to invalidate cached results
+PROMPT_VERSION = "v7"
+
+# C-level JSON parser for API responses (takes bytes on its fast path)
+_loads = orjson.loads
+
+# Export column layouts (explicit columns let pandas skip per-record schema inference)
+_VOTES_COLS = ['source_file', 'row_label', 'column_label', 'dot_count', 'color_breakdown']
+_NOTES_COLS = ['source_file', 'text', 'category_context', 'confidence']
+
+# Markdown fence patterns, compiled once at load instead of per response
+_JSON_FENCE = re.compile(r'```(?:json)?\s*')
+_TAIL_FENCE = re.compile(r'\s*```\s*$')
+
 def clean_json_string(json_str):
     """
     Cleans markdown formatting from JSON strings (e.g. ```json ... ```)
     """
-    json_str = re.sub(r'```json\s*', '', json_str)
-    json_str = re.sub(r'```\s*', '', json_str)
-    return json_str.strip()
+    # JSON-mode responses are usually unfenced, so skip the regex pass entirely
+    if not json_str.lstrip().startswith("```"):
+        return json_str.strip()
+    return _TAIL_FENCE.sub('', _JSON_FENCE.sub('', json_str)).strip()
+
+def _shrink(image_bytes, max_edge=2048, quality=85):
+    """
+    Downscales phone-camera uploads and re-encodes them as JPEG before they hit the API.
+    The vision model tiles at a fixed resolution, so extra megapixels only add upload time and tokens.
+    """
+    from PIL import Image, ImageOps
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes)))
+    img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    # JPEG has no alpha: flatten transparent exports onto white, or they'd come out black
+    if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+        rgba = img.convert("RGBA")
+        img = Image.new("RGB", rgba.size, (255, 255, 255))
+        img.paste(rgba, mask=rgba.getchannel("A"))
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=quality, optimize=True)
+    return buf.getvalue()
+
+def _to_int32(series):
+    """
+    Coerces model-reported counts to nullable Int32 without ever raising.
+    Non-numeric, fractional or out-of-range values become <NA> instead of killing the export.
+    """
+    import pandas as pd
+    values = pd.to_numeric(series, errors='coerce')
+    valid = (values % 1 == 0) & values.between(-2**31, 2**31 - 1)
+    return values.where(valid).astype('Int32')
+
+def _write_sheet(workbook, sheet_name, df):
+    """
+    Streams a DataFrame into a constant_memory worksheet one row at a time.
+    (pandas' to_excel writes column-by-column, which constant_memory mode silently drops.)
+    """
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, list(df.columns))
+    rows = df.astype(object).where(df.notna(), None)
+    for r, row in enumerate(rows.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(r, 0, row)
 
+@st.cache_data(ttl=300)
 def get_valid_models(api_key):
     """
     Prevents 404 Errors by asking Google exactly what this Key is allowed to touch.
     """
-    try:
-        genai.configure(api_key=api_key)
-        all_models = list(genai.list_models())
-        valid_models = [m.name for m in all_models if 'generateContent' in m.supported_generation_methods]
+    import google.ai.generativelanguage as glm
+    # Client bound to this key explicitly, never via the SDK's process-global configure(),
+    # so concurrent sessions with different keys can't pick up each other's credentials.
+    # Errors propagate to the caller: exceptions are never cached, so a transient
+    # failure is retried on the next run instead of sticking for the whole TTL.
+    client = glm.ModelServiceClient(client_options={"api_key": api_key})
+    all_models = list(client.list_models())
+    valid_models = [m.name for m in all_models if 'generateContent' in m.supported_generation_methods]
+    
+    def model_sort_key(name):
+        # Priority Rank: Gemini 3 -> 1.5 Pro -> 2.0 -> Flash
+        if "gemini-3" in name: return 0
+        if "gemini-1.5-pro" in name: return 1
+        if "gemini-2.0" in name: return 2
+        if "flash" in name: return 3
+        return 4
         
-        def model_sort_key(name):
-            # Priority Rank: Gemini 3 -> 1.5 Pro -> 2.0 -> Flash
-            if "gemini-3" in name: return 0
-            if "gemini-1.5-pro" in name: return 1
-            if "gemini-2.0" in name: return 2
-            if "flash" in name: return 3
-            return 4
-            
-        valid_models.sort(key=model_sort_key)
-        return valid_models
-    except Exception as e:
-        st.error(f"Authentication Error: {e}")
-        return []
+    valid_models.sort(key=model_sort_key)
+    return valid_models
 
-# --- 3. ANALYSIS ENGINE ---
-def analyze_single_image(image_bytes, model_name, filename, status_container=None):
+@st.cache_resource
+def _get_model(api_key, model_name):
+    """
+    Builds the model once per (key, model) instead of once per file.
+    The model is shared across sessions, so its client is bound to api_key here rather than
+    lazily taken from the process-global default on the first generate_content call.
+    """
+    import google.ai.generativelanguage as glm
+    import google.generativeai as genai
     model = genai.GenerativeModel(model_name)
+    model._client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+    return model
+
+# --- 3. ANALYSIS ENGINE ---
+# Static prompt + schema, built once at load instead of on every attempt.
+# Array bounds are enforced during decoding, capping output tokens and parse cost.
+FINAL_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "board_structure": {
+            "type": "OBJECT",
+            "properties": {
+                "board_type": {"type": "STRING"},
+                "row_headers": {"type": "ARRAY", "items": {"type": "STRING"}},
+                "column_headers": {"type": "ARRAY", "items": {"type": "STRING"}}
+            }
+        },
+        "voting_data": {
+            "type": "ARRAY",
+            "max_items": 500,
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "row_label": {"type": "STRING"},
+                    "column_label": {"type": "STRING"},
+                    "dot_count": {"type": "INTEGER"},
+                    "color_breakdown": {"type": "STRING"}
+                }
+            }
+        },
+        "sticky_notes": {
+            "type": "ARRAY",
+            "max_items": 500,
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "text": {"type": "STRING"},
+                    "category_context": {"type": "STRING"},
+                    "confidence": {"type": "INTEGER"}
+                }
+            }
+        }
+    },
+    "required": ["board_structure", "voting_data", "sticky_notes"]
+}
+
+FINAL_PROMPT = """
+Analyze this workshop board. First classify the board, then in the same JSON output
+list every matrix intersection and every sticky note.
+1. board_structure: CLASSIFY as "Dot Voting" (Matrix), "Sticky Notes" (Text), or "Hybrid".
+   If Matrix, identify Row Headers (Categories) and Column Headers (Sentiment/Options).
+2. voting_data: If Matrix, count dots/pins at every row/column intersection.
+   One entry per matrix cell. If empty, count=0.
+3. sticky_notes: Complete transcription of all legible handwritten text,
+   categorized by spatial clusters.
+"""
+
+def _run_pipeline(image_bytes, model_name, api_key):
+    import google.generativeai as genai
+    model = _get_model(api_key, model_name)
     
     # --- RETRY LOGIC WRAPPER ---
     max_retries = 3
     for attempt in range(max_retries):
         try:
-            # STAGE 1: Structural Recognition
-            if status_container:
-                status_container.write("🔹 Stage 1: Identifying Board Architecture...")
-                
-            structure_prompt = """
-            Analyze this workshop board.
-            1. CLASSIFY: Is it "Dot Voting" (Matrix), "Sticky Notes" (Text), or "Hybrid"?
-            2. MAPPING: If Matrix, identify Row Headers (Categories) and Column Headers (Sentiment/Options).
-            
-            Return JSON: {"board_type": "...", "row_headers": [], "column_headers": []}
-            """
-            
-            r1 = model.generate_content(
-                [{'mime_type': 'image/jpeg', 'data': image_bytes}, structure_prompt],
-                generation_config=genai.GenerationConfig(
-                    response_mime_type="application/json",
-                    temperature=0.0
-                )
-            )
-            # Clean JSON before loading
-            structure = json.loads(clean_json_string(r1.text))
-            
-            if status_container:
-                status_container.write(f"✅ Detected: {structure.get('board_type', 'Unknown')}")
-
-            # STAGE 2: Context Injection
-            if status_container:
-                status_container.write("🔹 Stage 2: Formulating Counting Strategy...")
-                
-            rows = structure.get('row_headers', [])
-            cols = structure.get('column_headers', [])
-            
-            context = ""
-            if rows and cols:
-                context = f"""
-                MATRIX DETECTED.
-                ROWS: {rows}
-                COLUMNS: {cols}
-                TASK: Count dots/pins at every intersection.
-                """
-            else:
-                context = "TEXT DETECTED. Extract all handwritten notes and categorize them by spatial clusters."
-
-            # STAGE 3: Final Extraction
-            if status_container:
-                status_container.write(f"🔹 Stage 3: Running Extraction on {model_name}...")
-                
-            final_schema = {
-                "type": "OBJECT",
-                "properties": {
-                    "voting_data": {
-                        "type": "ARRAY",
-                        "items": {
-                            "type": "OBJECT",
-                            "properties": {
-                                "row_label": {"type": "STRING"},
-                                "column_label": {"type": "STRING"},
-                                "dot_count": {"type": "INTEGER"},
-                                "color_breakdown": {"type": "STRING"}
-                            }
-                        }
-                    },
-                    "sticky_notes": {
-                        "type": "ARRAY",
-                        "items": {
-                            "type": "OBJECT",
-                            "properties": {
-                                "text": {"type": "STRING"},
-                                "category_context": {"type": "STRING"},
-                                "confidence": {"type": "INTEGER"}
-                            }
-                        }
-                    }
-                },
-                "required": ["voting_data", "sticky_notes"]
-            }
-            
-            final_prompt = f"""
-            {context}
-            REQUIREMENTS:
-            1. voting_data: One entry per matrix cell. If empty, count=0.
-            2. sticky_notes: Complete transcription of all legible text.
-            """
-            
+            # SINGLE PASS: Classification + Extraction in one multimodal call
             # INCREASED MAX TOKENS to prevent cut-off JSON
-            r3 = model.generate_content(
-                [{'mime_type': 'image/jpeg', 'data': image_bytes}, final_prompt],
+            r = model.generate_content(
+                [{'mime_type': 'image/jpeg', 'data': image_bytes}, FINAL_PROMPT],
                 generation_config=genai.GenerationConfig(
                     response_mime_type="application/json",
-                    response_schema=final_schema,
+                    response_schema=FINAL_SCHEMA,
                     temperature=0.0,
                     max_output_tokens=8192
                 )
             )
-            return json.loads(clean_json_string(r3.text)), None
+            result = _loads(clean_json_string(r.text).encode())
+            return {
+                "voting_data": result.get("voting_data", []),
+                "sticky_notes": result.get("sticky_notes", []),
+                "structure": result.get("board_structure", {})
+            }, None
 
         except Exception as e:
             error_msg = str(e)
-            # Check for Rate Limit (429) - Don't retry immediately, let the outer loop handle waiting
+            # Check for Rate Limit (429) - Don't retry immediately, report it back to the batch loop
             if "429" in error_msg:
                 return None, "429 Rate Limit"
             
             # For JSON errors or other glitches, retry
             if attempt < max_retries - 1:
-                if status_container:
-                    status_container.warning(f"⚠️ Attempt {attempt+1} failed. Retrying...")
                 time.sleep(2) # Brief pause before retry
                 continue
             else:
                 return None, f"Failed after {max_retries} attempts: {e}"
 
+@st.cache_data(persist="disk", max_entries=500, show_spinner=False)
+def _cached_analyze(img_hash, model_name, prompt_ver, _image_bytes, _api_key):
+    """
+    Content-addressed result cache: re-uploading the same board skips the API entirely.
+    Only the hash, model and prompt version form the key (underscore args are not hashed).
+    """
+    data, error = _run_pipeline(_image_bytes, model_name, _api_key)
+    if error:
+        # Exceptions are never cached, so failed files are retried on the next run
+        raise RuntimeError(error)
+    return data
+
+def analyze_single_image(image_bytes, model_name, api_key, max_edge):
+    # Decode/resize runs here in the worker; a bad upload fails only its own file
+    try:
+        image_bytes = _shrink(image_bytes, max_edge)
+    except Exception as e:  # PIL.UnidentifiedImageError, truncated files, ...
+        return None, f"Unreadable image: {e}"
+    img_hash = hashlib.sha256(image_bytes).hexdigest()
+    try:
+        return _cached_analyze(img_hash, model_name, PROMPT_VERSION, image_bytes, api_key), None
+    except RuntimeError as e:
+        return None, str(e)
+
 # --- 4. APPLICATION INTERFACE ---
 with st.sidebar:
     st.header("System Configuration")
@@ -219,7 +287,11 @@ with st.sidebar:
 
     # Dynamic Model Selector
     if api_key:
-        valid_models = get_valid_models(api_key)
+        try:
+            valid_models = get_valid_models(api_key)
+        except Exception as e:
+            st.error(f"Authentication Error: {e}")
+            valid_models = []
         if valid_models:
             selected_model = st.selectbox("Processing Engine", valid_models, index=0)
             if "gemini-3" in selected_model:
@@ -231,6 +303,16 @@ with st.sidebar:
         st.warning("Awaiting Credentials...")
         st.stop()
 
+    # Concurrent API calls per batch (lower this if you hit 429s)
+    parallelism = st.slider("Parallelism", 1, 16, 4)
+
+    # Longest image edge sent to the API (lower = faster, higher = finer detail)
+    max_edge = st.slider("Max edge (px)", 1024, 4096, 2048, step=256)
+
+    if st.button("Clear cache"):
+        st.cache_data.clear()
+        st.toast("Cached results cleared.")
+
 # Main Upload Area
 uploaded_files = st.file_uploader(
     "Batch Upload Board Images", 
@@ -238,82 +320,130 @@ uploaded_files = st.file_uploader(
     accept_multiple_files=True
 )
 
-if uploaded_files and st.button(f"Process {len(uploaded_files)} Files"):
-    
+def process_batch(uploaded_files, selected_model, api_key, parallelism, max_edge):
+    """
+    Analyzes every upload and returns the aggregated rows plus their source filenames.
+    """
     # Master Data Containers
     all_votes = []
     all_notes = []
+    vote_sources = []  # Parallel to all_votes; assigned as one column after the batch
+    note_sources = []
+    
+    # Deduplicate identical uploads before spending any API calls on them
+    unique_files = []
+    names_by_hash = {}
+    for file in uploaded_files:
+        h = hashlib.sha256(file.getvalue()).digest()
+        if h not in names_by_hash:
+            names_by_hash[h] = []
+            unique_files.append((h, file))
+        names_by_hash[h].append(file.name)
     
     # GLOBAL PROGRESS BAR
     progress_bar = st.progress(0)
+    rate_limited = []
     
-    # Batch Processing Loop
-    for i, file in enumerate(uploaded_files):
+    # Parallel Batch Processing (API calls are I/O-bound and independent per file).
+    # Workers never touch Streamlit; all UI updates happen here on the main thread.
+    _get_model(api_key, selected_model)  # Warm the model cache before workers share it
+    executor = ThreadPoolExecutor(max_workers=min(parallelism, len(unique_files)))
+    try:
+        futures = {
+            executor.submit(analyze_single_image, file.getvalue(), selected_model, api_key, max_edge): (h, file)
+            for h, file in unique_files
+        }
         
-        # LIVE STATUS CONTAINER
-        with st.status(f"Processing **{file.name}**...", expanded=True) as status:
-            image_bytes = file.getvalue()
+        for i, future in enumerate(as_completed(futures)):
+            h, file = futures[future]
+            names = names_by_hash[h]
+            data, error = future.result()
             
-            # Pass the status container to the function
-            data, error = analyze_single_image(image_bytes, selected_model, file.name, status_container=status)
-            
-            if error:
-                if "429" in str(error):
-                    status.update(label=f"⚠️ Rate Limit Hit on {file.name}", state="error")
-                    st.warning("API Rate Limit reached. Cooling down for 60s...")
-                    # Visual Countdown
-                    with st.empty():
-                        for seconds in range(60, 0, -1):
-                            st.write(f"⏳ Resuming in {seconds}s...")
-                            time.sleep(1)
-                        st.write("🔄 Resuming...")
-                else:
-                    status.update(label=f"❌ Failed: {file.name}", state="error")
-                    st.error(f"Skipped {file.name}: {error}")
-            
-            elif data:
-                status.update(label=f"✅ Completed: {file.name}", state="complete")
-                
-                # Aggregate Data
-                if data.get("voting_data"):
-                    for v in data["voting_data"]:
-                        v["source_file"] = file.name
-                        all_votes.append(v)
+            # LIVE STATUS CONTAINER
+            with st.status(f"Processing **{file.name}**...", expanded=False) as status:
+                if error:
+                    if "429" in str(error):
+                        status.update(label=f"⚠️ Rate Limit Hit on {file.name}", state="error")
+                        rate_limited.extend(names)
+                    else:
+                        status.update(label=f"❌ Failed: {file.name}", state="error")
+                        st.error(f"Skipped {file.name}: {error}")
                 
-                if data.get("sticky_notes"):
-                    for n in data["sticky_notes"]:
-                        n["source_file"] = file.name
-                        all_notes.append(n)
-        
-        # Update Global Progress
-        progress_bar.progress((i + 1) / len(uploaded_files))
+                elif data:
+                    status.update(label=f"✅ Completed: {file.name}", state="complete")
+                    status.write(f"✅ Detected: {data['structure'].get('board_type', 'Unknown')}")
+                    if len(names) > 1:
+                        status.write(f"♻️ Identical upload, results reused for: {', '.join(names[1:])}")
+                    
+                    # Aggregate Data (fanned out to every filename sharing this image)
+                    votes = data.get("voting_data") or []
+                    notes = data.get("sticky_notes") or []
+                    for name in names:
+                        all_votes.extend(votes)
+                        vote_sources.extend([name] * len(votes))
+                        all_notes.extend(notes)
+                        note_sources.extend([name] * len(notes))
+            
+            # Update Global Progress
+            progress_bar.progress((i + 1) / len(unique_files))
+    except BaseException:
+        # Stop button / widget rerun lands here as a control exception: drop queued
+        # files instead of letting shutdown(wait=True) finish (and bill) all of them
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+    if rate_limited:
+        st.warning(
+            f"API Rate Limit reached on {len(rate_limited)} file(s): {', '.join(rate_limited)}. "
+            "Lower **Parallelism** in the sidebar and re-run them."
+        )
 
     st.success("Batch Processing Complete.")
     
+    return all_votes, vote_sources, all_notes, note_sources
+
+if uploaded_files and st.button(f"Process {len(uploaded_files)} Files"):
+    import pandas as pd
+    import xlsxwriter
+    
+    all_votes, vote_sources, all_notes, note_sources = process_batch(
+        uploaded_files, selected_model, api_key, parallelism, max_edge
+    )
+    
     # --- 5. CONSOLIDATED EXPORT ---
     st.divider()
     st.subheader("Global Data Export")
     
     col1, col2 = st.columns(2)
     
-    df_votes = pd.DataFrame(all_votes)
-    df_notes = pd.DataFrame(all_notes)
+    # Nullable Int32: the schema doesn't force the model to emit every count
+    df_votes = pd.DataFrame.from_records(all_votes, columns=_VOTES_COLS, coerce_float=False)
+    df_votes['source_file'] = vote_sources
+    df_votes['dot_count'] = _to_int32(df_votes['dot_count'])
+    df_notes = pd.DataFrame.from_records(all_notes, columns=_NOTES_COLS, coerce_float=False)
+    df_notes['source_file'] = note_sources
+    df_notes['confidence'] = _to_int32(df_notes['confidence'])
     
-    # Excel Export (Multi-Tab)
-    buffer = io.BytesIO()
-    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-        if not df_votes.empty:
-            df_votes.to_excel(writer, sheet_name='Dot Voting Data', index=False)
-        if not df_notes.empty:
-            df_notes.to_excel(writer, sheet_name='Sticky Notes Text', index=False)
-            
-    with col1:
-        st.download_button(
-            label="📥 Download Consolidated Excel",
-            data=buffer.getvalue(),
-            file_name="Banetti_Workshop_Data.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+    # Excel Export (Multi-Tab) - skipped entirely when nothing was extracted
+    if not df_votes.empty or not df_notes.empty:
+        # constant_memory flushes each row to disk, so memory stays flat for large batches
+        buffer = io.BytesIO()
+        with xlsxwriter.Workbook(buffer, {'constant_memory': True}) as workbook:
+            if not df_votes.empty:
+                _write_sheet(workbook, 'Dot Voting Data', df_votes)
+            if not df_notes.empty:
+                _write_sheet(workbook, 'Sticky Notes Text', df_notes)
+                
+        with col1:
+            st.download_button(
+                label="📥 Download Consolidated Excel",
+                data=buffer.getvalue(),
+                file_name="Banetti_Workshop_Data.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+    else:
+        st.info("No voting data or sticky notes were extracted, so there is nothing to export.")
 
     # Master CSV Export (Notes Only)
     with col2: